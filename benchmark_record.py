@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+# Compares the compact memcache record format against pickle, which is what
+# memcache falls back to for the (content, updated) tuples we used to store.
+# Needs the App Engine SDK on PYTHONPATH since it imports main:
+#
+#     PYTHONPATH=$APPENGINE_SDK:$APPENGINE_SDK/lib/webapp2 python benchmark_record.py
+#
+import cPickle, timeit
+from datetime import datetime
+
+from main import AnimeEntry, encodeRecord, decodeRecord
+
+RUNS = 100000
+
+content = {
+    'id': u'21',
+    'title': u'One Piece',
+    'image': u'http://cdn.myanimelist.net/images/anime/6/73245.jpg',
+    'score': 8.54,
+    'episodes': None,
+    'genres': [u'Action', u'Adventure', u'Comedy', u'Drama', u'Fantasy', u'Shounen', u'Super Power']
+}
+updated = datetime(2012, 5, 1, 12, 0, 0)
+
+pickled = cPickle.dumps((content, updated), cPickle.HIGHEST_PROTOCOL)
+record = encodeRecord(AnimeEntry(content, updated))
+
+print 'format  bytes  decode us'
+print 'pickle  %5d  %9.2f' % (len(pickled), timeit.timeit(lambda: AnimeEntry(*cPickle.loads(pickled)), number = RUNS) * 1e6 / RUNS)
+print 'record  %5d  %9.2f' % (len(record), timeit.timeit(lambda: decodeRecord('21', record), number = RUNS) * 1e6 / RUNS)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#
+# Checks the single-pass MALSITE extractor against a page with all of its markup
+# on one line, where a greedy field pattern would swallow the fields after it.
+# Needs the App Engine SDK on PYTHONPATH since it imports main:
+#
+#     PYTHONPATH=$APPENGINE_SDK:$APPENGINE_SDK/lib/webapp2 python check_extractors.py
+#
+from main import formatResponse
+
+page = ''.join([
+    '<html><body>',
+    '<h1><div style="float: right; font-size: 13px;">Ranked #1</div>Fullmetal Alchemist: Brotherhood</h1>',
+    '<div><a href="/anime/5114/pics"><img src="http://cdn.myanimelist.net/images/anime/5/47421.jpg" alt=""></a></div>',
+    '<div><span class="dark_text">Episodes:</span> 64 </div>',
+    '<div><span class="dark_text">Genres:</span> <a href="/anime.php?genre[]=1">Action</a>, <a href="/anime.php?genre[]=2">Adventure</a></div>',
+    '<div><span class="dark_text">Score:</span> 9.1 <sup>1</sup></div>',
+    '</body></html>'
+])
+
+expected = {
+    'title': u'Fullmetal Alchemist: Brotherhood',
+    'image': 'http://cdn.myanimelist.net/images/anime/5/47421.jpg',
+    'score': 9.1,
+    'episodes': 64,
+    'genres': ['Action', 'Adventure']
+}
+
+for name, content in (('one line', page), ('one tag per line', page.replace('><', '>\n<'))):
+    result = formatResponse(content, True)
+    assert result == expected, name + ': ' + repr(result)
+    print name + ': ok'
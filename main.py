@@ -14,18 +14,80 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import re, cgi, logging
+import re, cgi, logging, time, threading, hashlib, calendar, zlib, marshal, cPickle, bisect, random
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from urlparse import urlparse
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import webapp2, json
 from google.appengine.ext import db
-from google.appengine.api import urlfetch, memcache
+from google.appengine.api import urlfetch, memcache, taskqueue, users, datastore, apiproxy_stub_map, apiproxy_rpc
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 MALAPI = 'http://mal-api.com/anime/'
 MALSITE = 'http://myanimelist.net/anime/'
 
+MAX_BATCH = 50
+MIGRATE_BATCH = 100
+WARMUP_BATCH = 50
+WARMUP_MAX = 1000
+INVALIDATE_WARMUP = 500
+CRAWL_PER_MINUTE = 20
+FRESH_AGE = timedelta(hours=24)
+CRAWL_MIN_AGE = FRESH_AGE
+CRAWL_FAILURE_TTL = 6 * 3600
+LEASE_TTL = 30
+LEASE_WAIT = 2
+LEASE_POLL = 0.2
+RETRY_AFTER = 5
+REFRESH_LEASE_TTL = 300
+STALE_WHILE_REVALIDATE = True
+STALE_MAX_AGE = 300
+RESET_LIMIT = 1
+RESET_WINDOW = 300
+NOT_FOUND_TTL = 3600
+UPSTREAM_ERROR_TTL = 60
+COMPARED_PROPERTIES = ('title', 'image', 'score', 'episodes', 'genres', 'document')
+STORE_TASK_BYTES = 90000
+BASIC_FIELDS = frozenset(['id', 'title', 'image', 'score', 'episodes', 'genres'])
+UPSTREAM_CONCURRENCY = 10
+FETCH_BUDGET = 20
+HEDGE_POLL = 0.05
+MIN_DEADLINE = 2
+MAX_DEADLINE = 10
+DEADLINE_FACTOR = 2
+LATENCY_SAMPLES = 100
+LATENCY_PERCENTILE = 0.95
+BREAKER_WINDOW = 60
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 120
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_TTL = 60
+CACHE_NAMESPACE = 'anime:v1:'
+GENERATION_TTL = 10
+GZIP_LEVEL = 6
+STAGES = ('total', 'memcache', 'datastore', 'malapi', 'malsite', 'format', 'store', 'serialize')
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+STATS_FLUSH_INTERVAL = 60
+TIERS = ('local', 'memcache', 'negative', 'datastore_fresh', 'datastore_stale', 'malapi', 'malsite', 'failure')
+COUNTER_WINDOW = 3600
+COUNTER_SHARDS = 10
+UPSTREAM_LOG_SAMPLE = 0.01
+DEBUG_CONFIG_TTL = 60
+DEBUG_BODY_BYTES = 2048
+CHANGE_PROPERTIES = ('score', 'episodes', 'genres')
+CHANGES_LIMIT = 500
+CHANGES_SETTLE = 5
+EXPORT_BATCH = 500
+EXPORT_LIMIT = 5000
+RECORD_VERSION = 1
+RECORD_ZLIB = 1
+RECORD_COMPRESS_MIN = 512
+RECORD_FIELDS = ('title', 'image', 'score', 'episodes', 'genres')
+
 class AnimeV1(db.Model):
     id = db.StringProperty(required=True)
     title = db.StringProperty(required=True)
@@ -33,8 +95,291 @@ class AnimeV1(db.Model):
     score = db.FloatProperty(required=True)
     episodes = db.IntegerProperty()
     genres = db.StringListProperty()
+    document = db.BlobProperty()
     updated_datetime = db.DateTimeProperty(auto_now=True)
 
+class AnimeV1Change(db.Model):
+    # Old and new values of every CHANGE_PROPERTIES that moved in one AnimeV1 write, as JSON.
+    # recorded_datetime is set when the row is put, so deferred writes never land behind a poller's since.
+    id = db.StringProperty(required=True)
+    changes = db.TextProperty(required=True)
+    recorded_datetime = db.DateTimeProperty(auto_now=True)
+
+class UpstreamDebug(db.Model):
+    # Single row, key name 'upstream', set at /admin/debug/upstream. Logs every upstream fetch with
+    # the start of its body when enabled, or only the fetches of the listed ids.
+    enabled = db.BooleanProperty(default=False)
+    ids = db.StringListProperty()
+
+class LRUCache(object):
+    # Bounded, thread-safe, process-local cache with a TTL on every entry
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def getMulti(self, keys, prefix='', countMisses=True):
+        # Like memcache.get_multi, the prefix is added to the stored keys but not to the returned ones.
+        # Callers polling for the same keys again pass countMisses=False.
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(prefix + key, None)
+                if entry is None or entry[1] < now:
+                    if countMisses: self.misses += 1
+                    continue
+                self._entries[prefix + key] = entry
+                found[key] = entry[0]
+                self.hits += 1
+        return found
+
+    def setMulti(self, mapping, prefix=''):
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries.pop(prefix + key, None)
+                self._entries[prefix + key] = (value, expires)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+class Timings(object):
+    # Stage durations of one request, summed per stage in the order the stages first ran
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def header(self):
+        return ', '.join('%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in self.stages.items())
+
+class LatencyHistogram(object):
+    # Bucketed stage latencies for this instance, added into shared memcache counters
+    # every STATS_FLUSH_INTERVAL seconds so /v1/stats sees every instance
+    def __init__(self):
+        self._counts = {}
+        self._totals = {}
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        ms = seconds * 1000
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, ms)
+        with self._lock:
+            key = stage + ':' + str(bucket)
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._totals[stage + ':ms'] = self._totals.get(stage + ':ms', 0) + ms
+
+    def flush(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._flushed < STATS_FLUSH_INTERVAL: return
+            deltas = self._counts
+            deltas.update((key, int(ms)) for key, ms in self._totals.items())
+            self._counts = {}
+            self._totals = {}
+            self._flushed = time.time()
+        if deltas:
+            memcache.offset_multi(deltas, key_prefix = 'stats:', initial_value = 0)
+
+def latencyStats():
+    # Count, average and percentiles per stage, percentiles being the upper bound of their bucket
+    keys = []
+    for stage in STAGES:
+        keys.append(stage + ':ms')
+        keys.extend(stage + ':' + str(bucket) for bucket in range(len(LATENCY_BUCKETS) + 1))
+    counters = memcache.get_multi(keys, key_prefix = 'stats:')
+    stats = {}
+    for stage in STAGES:
+        buckets = [int(counters.get(stage + ':' + str(bucket)) or 0) for bucket in range(len(LATENCY_BUCKETS) + 1)]
+        count = sum(buckets)
+        if not count: continue
+        stats[stage] = {'count': count, 'avg_ms': int(counters.get(stage + ':ms') or 0) / float(count)}
+        for name, percentile in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+            seen = 0
+            for bucket, n in enumerate(buckets):
+                seen += n
+                if seen >= percentile * count:
+                    stats[stage][name] = LATENCY_BUCKETS[min(bucket, len(LATENCY_BUCKETS) - 1)]
+                    break
+    return stats
+
+class ShardedCounters(object):
+    # Named counts buffered per instance and added every STATS_FLUSH_INTERVAL seconds into one of
+    # COUNTER_SHARDS memcache keys per COUNTER_WINDOW, so busy instances do not all bump the same key
+    def __init__(self, prefix, names):
+        self.prefix = prefix
+        self.names = names
+        self._counts = {}
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    def incr(self, name, delta=1):
+        if not delta: return
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + delta
+            due = time.time() - self._flushed >= STATS_FLUSH_INTERVAL
+        if due: self.flush()
+
+    def flush(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._flushed < STATS_FLUSH_INTERVAL: return
+            counts = self._counts
+            self._counts = {}
+            self._flushed = time.time()
+        if not counts: return
+        window = int(time.time() // COUNTER_WINDOW)
+        shard = random.randrange(COUNTER_SHARDS)
+        memcache.offset_multi(dict(('%d:%s:%d' % (window, name, shard), n) for name, n in counts.items()), key_prefix = self.prefix, initial_value = 0)
+
+    def read(self, window):
+        keys = ['%d:%s:%d' % (window, name, shard) for name in self.names for shard in range(COUNTER_SHARDS)]
+        values = memcache.get_multi(keys, key_prefix = self.prefix)
+        return dict((name, sum(int(values.get('%d:%s:%d' % (window, name, shard)) or 0) for shard in range(COUNTER_SHARDS))) for name in self.names)
+
+latencyHistogram = LatencyHistogram()
+tierCounters = ShardedCounters('tiers:', TIERS)
+requestState = threading.local()
+
+def startTiming():
+    requestState.timings = Timings()
+
+def finishTiming(response):
+    timings = getattr(requestState, 'timings', None)
+    if timings is None: return
+    requestState.timings = None
+    recordTiming('total', time.time() - timings.started, timings)
+    response.headers['Server-Timing'] = timings.header()
+    latencyHistogram.flush()
+
+def recordTiming(stage, seconds, timings=None):
+    # Only /v1/anime requests time their stages, work done anywhere else is left out of the histogram
+    if timings is None: timings = getattr(requestState, 'timings', None)
+    if timings is None: return
+    timings.add(stage, seconds)
+    latencyHistogram.add(stage, seconds)
+
+@contextmanager
+def timed(stage):
+    started = time.time()
+    try:
+        yield
+    finally:
+        recordTiming(stage, time.time() - started)
+
+class AnimeEntry(object):
+    # A cached record along with its serialized response and validators, built at most once per entry
+    __slots__ = ('content', 'updated', '_body', '_etag', '_gzipBody')
+
+    def __init__(self, content, updated):
+        self.content = content
+        self.updated = updated
+        self._body = None
+        self._etag = None
+        self._gzipBody = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = json.dumps({'ok': True, 'result': self.content}, sort_keys=True)
+        return self._body
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = '"' + hashlib.md5(self.body).hexdigest() + '"'
+        return self._etag
+
+    @property
+    def gzipBody(self):
+        if self._gzipBody is None:
+            self._gzipBody = gzipBytes(self.body)
+        return self._gzipBody
+
+localCache = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+generationCache = LRUCache(1, GENERATION_TTL)
+debugCache = LRUCache(1, DEBUG_CONFIG_TTL)
+
+def cachePrefix():
+    # Every cached record, document and negative result lives under the current generation,
+    # so bumping the counter invalidates all of them at once without a flush. The counter is
+    # kept in-process for GENERATION_TTL seconds to save an RPC per request.
+    generation = generationCache.getMulti(['generation']).get('generation')
+    if generation is None:
+        generation = memcache.get(CACHE_NAMESPACE + 'generation')
+        if generation is None:
+            # Start from the clock so a flushed counter never reuses an older generation
+            memcache.add(CACHE_NAMESPACE + 'generation', int(time.time()))
+            generation = memcache.get(CACHE_NAMESPACE + 'generation')
+        generationCache.setMulti({'generation': generation})
+    return CACHE_NAMESPACE + str(generation) + ':'
+
+def bumpCacheGeneration():
+    generation = memcache.incr(CACHE_NAMESPACE + 'generation', initial_value = int(time.time()))
+    generationCache.clear()
+    localCache.clear()
+    return generation
+
+def cacheGetMulti(ids, tiers=None, polling=False):
+    # In-process LRU first, memcache for the rest. The tier each id was found in goes into tiers.
+    prefix = cachePrefix()
+    found = localCache.getMulti(ids, prefix, not polling)
+    if tiers is not None: tiers.update((i, 'local') for i in found)
+    missing = [i for i in ids if i not in found]
+    if missing:
+        cached = {}
+        with timed('memcache'):
+            values = memcache.get_multi(missing, key_prefix = prefix)
+        for i, value in values.items():
+            entry = decodeRecord(i, value)
+            if entry is not None:
+                cached[i] = entry
+        localCache.setMulti(cached, prefix)
+        if tiers is not None: tiers.update((i, 'memcache') for i in cached)
+        found.update(cached)
+    return found
+
+def cacheSetMulti(entries):
+    prefix = cachePrefix()
+    localCache.setMulti(entries, prefix)
+    memcache.set_multi(dict((i, encodeRecord(entry)) for i, entry in entries.items()), 43200, key_prefix = prefix)
+    return entries
+
+def encodeRecord(entry):
+    # Schema version byte, flags byte, then the marshalled RECORD_FIELDS values and the
+    # updated timestamp. Fixed field order means no keys are stored, and marshal decodes
+    # faster than pickle. The id is the memcache key so it is not stored either.
+    values = tuple(entry.content.get(f) for f in RECORD_FIELDS) + (calendar.timegm(entry.updated.timetuple()),)
+    data = marshal.dumps(values)
+    flags = 0
+    if len(data) >= RECORD_COMPRESS_MIN:
+        data = zlib.compress(data)
+        flags |= RECORD_ZLIB
+    return chr(RECORD_VERSION) + chr(flags) + data
+
+def decodeRecord(id, value):
+    # Anything not written by this RECORD_VERSION, including older pickled values, is a miss
+    if not isinstance(value, str) or len(value) < 2 or ord(value[0]) != RECORD_VERSION: return None
+    data = value[2:]
+    if ord(value[1]) & RECORD_ZLIB:
+        data = zlib.decompress(data)
+    values = marshal.loads(data)
+    content = dict(zip(RECORD_FIELDS, values))
+    content['id'] = id
+    return AnimeEntry(content, datetime.utcfromtimestamp(values[-1]))
+
 class MainHandler(webapp2.RequestHandler):
     def get(self):
         self.response.out.write('<!DOCTYPE html>\
@@ -47,152 +392,1055 @@ class MainHandler(webapp2.RequestHandler):
 
 class AnimeV1Handler(webapp2.RequestHandler):
     def get(self):
+        startTiming()
+        try:
+            self.respond()
+        finally:
+            finishTiming(self.response)
+
+    def respond(self):
         id = cgi.escape(self.request.get('id'))
+        ids = cgi.escape(self.request.get('ids'))
         callback = cgi.escape(self.request.get('callback'))
         reset = cgi.escape(self.request.get('_reset'))
+        fields = uniqueList(self.request.get('fields').split(','))
+        fields = [f for f in fields if re.match(r'^\w+$', f)]
 
-        response = {'ok': True, 'result': None}
+        if not (callback and re.match(r'^[A-Za-z_$][A-Za-z0-9_$]*?$', callback)):
+            callback = None
+        gzipped = acceptsGzip(self.request)
 
-        if re.match(r"^\d+$", id):
-            content = memcache.get(id)
-            if content is not None and not reset:
-                response['result'] = content
-            else:
-                q = db.GqlQuery('select * from AnimeV1 where id = :1', id)
-                result = q.get()
-                originalScore = None
-                if result is not None: originalScore = result.score
-                if result is not None and (datetime.now() - result.updated_datetime <= timedelta(hours=24)):
-                    content = {
-                        'id': result.id,
-                        'title': result.title,
-                        'image': result.image,
-                        'score': result.score,
-                        'episodes': result.episodes,
-                        'genres': result.genres
-                    }
-                    response['result'] = content
-                    memcache.set(id, content, 43200)
-                else:
-                    try:
-                        logging.info('Fetching ' + MALAPI + id)
-                        result = urlfetch.fetch(MALAPI + id, deadline = 10)
-                        logging.info(result.status_code)
-                        if result.status_code == 200:
-                            content = formatResponse(result.content)
-                            response['result'] = content
-                            storeAnimeV1(id, content)
-                            if originalScore is not None and content['score'] != originalScore:
-                                logging.info('Anime Score Change: ' + content['title'] + ' ' + id + ': ' + str(originalScore) + ' -> ' + str(content['score']))
-                        else:
-                            raise urlfetch.Error()
-                    except urlfetch.Error:
-                        # Try one more time before giving up
-                        try:
-                            logging.info('Fetching ' + MALSITE + id)
-                            result = urlfetch.fetch(MALSITE + id, deadline = 10, allow_truncated = True)
-                            logging.info(result.content)
-                            if result.status_code == 200:
-                                content = formatResponse(result.content, True)
-                                if content is None:
-                                    raise urlfetch.Error()
-                                    return
-                                response['result'] = content
-                                storeAnimeV1(id, content)
-                                if originalScore is not None and content['score'] != originalScore:
-                                    logging.info('Anime Score Change: ' + content['title'] + ' ' + id + ': ' + str(originalScore) + ' -> ' + str(content['score']))
-                            else:
-                                raise urlfetch.Error()
-                        except urlfetch.Error:
-                            response['ok'] = False
-        else:
-            response['ok'] = False
+        ok = False
+        batch = None
+        entries = None
+        errors = {}
+        etag = None
+        lastModified = None
+        stale = None
 
-        jsonData = json.dumps(response, sort_keys=True)
-        if callback and re.match(r'^[A-Za-z_$][A-Za-z0-9_$]*?$', callback):
-            jsonData = callback + '(' + jsonData + ')'
+        if ids:
+            batch = uniqueList(ids.split(','))
+            if len(batch) <= MAX_BATCH:
+                validIds = [i for i in batch if re.match(r"^\d+$", i)]
+                if reset: reset = allowReset(validIds)
+                tiers = {}
+                entries, stale, errors = getAnimeV1(validIds, reset, tiers)
+                countTiers(tiers)
+                if fields: entries = projectAnimeV1(entries, fields)
+                ok = len(entries) == len(batch)
+                if ok and entries:
+                    etag = '"' + hashlib.md5('\n'.join(i + entries[i].etag for i in sorted(batch))).hexdigest() + '"'
+                    lastModified = max(entry.updated for entry in entries.values())
+        elif re.match(r"^\d+$", id):
+            if reset: reset = allowReset([id])
+            tiers = {}
+            entries, stale, errors = getAnimeV1([id], reset, tiers)
+            countTiers(tiers)
+            if fields: entries = projectAnimeV1(entries, fields)
+            if id in entries:
+                ok = True
+                etag = entries[id].etag
+                lastModified = entries[id].updated
 
-        if response['ok'] is True and response['result'] is not None:
-            self.response.headers['Cache-Control'] = 'public; max-age=43200'
+        if ok:
+            if stale:
+                self.response.headers['Cache-Control'] = 'public; max-age=' + str(STALE_MAX_AGE)
+                self.response.headers['Warning'] = '110 - "Response is Stale"'
+            else:
+                self.response.headers['Cache-Control'] = 'public; max-age=43200'
+            if etag is not None:
+                if callback: etag = etag[:-1] + '-' + callback + '"'
+                if gzipped: etag = etag[:-1] + '-gzip"'
+                self.response.headers['ETag'] = etag
+            if lastModified is not None:
+                self.response.headers['Last-Modified'] = httpDate(lastModified)
+        elif 'upstream_error' in errors.values():
+            self.response.headers['Retry-After'] = str(RETRY_AFTER)
         self.response.headers['Content-Type'] = 'application/javascript; charset=utf-8'
         self.response.headers['Vary'] = 'Accept-Encoding'
         self.response.headers['Proxy-Connection'] = 'Keep-Alive'
         self.response.headers['Connection'] = 'Keep-Alive'
         self.response.headers['Access-Control-Allow-Origin'] = '*'
+
+        if ok and notModified(self.request, etag, lastModified):
+            self.response.set_status(304)
+            return
+
+        if gzipped:
+            self.response.headers['Content-Encoding'] = 'gzip'
+        with timed('serialize'):
+            if gzipped and ok and batch is None and not callback:
+                # Single records keep their compressed body around, everything else is compressed per request
+                jsonData = entries[id].gzipBody
+            else:
+                if batch is not None and entries is not None:
+                    jsonData = batchBody(batch, entries, errors)
+                elif batch is not None:
+                    jsonData = errorBody('too_many_ids')
+                elif ok:
+                    jsonData = entries[id].body
+                else:
+                    jsonData = errorBody(errors.get(id, 'invalid_id'))
+                if callback:
+                    jsonData = callback + '(' + jsonData + ')'
+                if gzipped:
+                    jsonData = gzipBytes(jsonData)
         self.response.out.write(jsonData)
 
+class StatsV1Handler(webapp2.RequestHandler):
+    def get(self):
+        latencyHistogram.flush(True)
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.out.write(json.dumps({'ok': True, 'result': latencyStats()}, sort_keys=True))
+
+class ChangesV1Handler(webapp2.RequestHandler):
+    # Changes recorded after since, oldest first. Clients poll again with the returned since until result is empty.
+    # The newest CHANGES_SETTLE seconds are held back to give the eventually consistent query time to catch up.
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Access-Control-Allow-Origin'] = '*'
+        since = parseSince(self.request.get('since'))
+        if since is None:
+            self.response.set_status(400)
+            self.response.out.write(errorBody('invalid_since'))
+            return
+        until = datetime.now() - timedelta(seconds = CHANGES_SETTLE)
+        rows = AnimeV1Change.all().filter('recorded_datetime >', since).filter('recorded_datetime <=', until).order('recorded_datetime').fetch(CHANGES_LIMIT)
+        result = [{'id': row.id, 'changes': json.loads(row.changes), 'time': row.recorded_datetime.isoformat()} for row in rows]
+        self.response.out.write(json.dumps({
+            'ok': True,
+            'result': result,
+            'since': rows[-1].recorded_datetime.isoformat() if rows else since.isoformat()
+        }, sort_keys=True))
+
+class ExportV1Handler(webapp2.RequestHandler):
+    # Every AnimeV1 row as newline-delimited JSON, written out EXPORT_BATCH rows at a time. When more rows
+    # are left after EXPORT_LIMIT the X-Cursor header is set, pass it back as cursor (with the same since) to resume.
+    def get(self):
+        since = None
+        if self.request.get('since'):
+            since = parseSince(self.request.get('since'))
+            if since is None:
+                self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+                self.response.set_status(400)
+                self.response.out.write(errorBody('invalid_since'))
+                return
+        q = AnimeV1.all()
+        if since is not None:
+            q.filter('updated_datetime >', since).order('updated_datetime')
+        cursor = self.request.get('cursor')
+        try:
+            if cursor: q.with_cursor(cursor)
+            batch = q.fetch(EXPORT_BATCH)
+        except (db.BadValueError, db.BadRequestError):
+            self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+            self.response.set_status(400)
+            self.response.out.write(errorBody('invalid_cursor'))
+            return
+
+        self.response.headers['Content-Type'] = 'application/x-ndjson; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Access-Control-Allow-Origin'] = '*'
+        exported = 0
+        while batch:
+            self.response.out.write(''.join(json.dumps(dict(animeContent(anime), updated = anime.updated_datetime.isoformat()), sort_keys=True) + '\n' for anime in batch))
+            exported += len(batch)
+            if len(batch) < EXPORT_BATCH: break
+            cursor = q.cursor()
+            if exported >= EXPORT_LIMIT:
+                self.response.headers['X-Cursor'] = cursor
+                break
+            batch = q.with_cursor(cursor).fetch(EXPORT_BATCH)
+
+def parseSince(value):
+    # ISO 8601 UTC as returned in since, with or without microseconds. Missing means from the start.
+    if not value: return datetime(1970, 1, 1)
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    return None
+
+class TierStatsHandler(webapp2.RequestHandler):
+    # Where ids were served from in the current and previous COUNTER_WINDOW, across all instances,
+    # plus this instance's local cache counters and per-field extraction timings
+    def get(self):
+        tierCounters.flush(True)
+        window = int(time.time() // COUNTER_WINDOW)
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.out.write(json.dumps({
+            'window': COUNTER_WINDOW,
+            'current': tierCounters.read(window),
+            'previous': tierCounters.read(window - 1),
+            'instance': localCache.stats(),
+            'extractors': {'malapi': MALAPI_EXTRACTOR.timings(), 'malsite': MALSITE_EXTRACTOR.timings()}
+        }, sort_keys=True))
+
+def acceptsGzip(request):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'): continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def gzipBytes(data):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def httpDate(dt):
+    return formatdate(calendar.timegm(dt.timetuple()), usegmt = True)
+
+def notModified(request, etag, lastModified):
+    # If-None-Match wins over If-Modified-Since when both are sent
+    ifNoneMatch = request.headers.get('If-None-Match')
+    if ifNoneMatch:
+        if etag is None: return False
+        tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+    ifModifiedSince = request.headers.get('If-Modified-Since')
+    if ifModifiedSince and lastModified is not None:
+        since = parsedate_tz(ifModifiedSince)
+        if since is None: return False
+        return calendar.timegm(lastModified.timetuple()) <= mktime_tz(since)
+    return False
+
+def uniqueList(values):
+    seen = set()
+    unique = []
+    for value in values:
+        value = value.strip()
+        if value and value not in seen:
+            seen.add(value)
+            unique.append(value)
+    return unique
+
+def batchBody(ids, entries, errors):
+    # Same bytes as json.dumps(..., sort_keys=True) would give, reusing each entry's cached body
+    parts = []
+    for i in sorted(ids):
+        entry = entries.get(i)
+        parts.append(json.dumps(i) + ': ' + (entry.body if entry is not None else errorBody(errors.get(i, 'invalid_id'))))
+    ok = 'true' if len(entries) == len(ids) else 'false'
+    return '{"ok": ' + ok + ', "result": {' + ', '.join(parts) + '}}'
+
+def allowReset(ids):
+    # Admins can always force a refresh, everyone else gets RESET_LIMIT per id every RESET_WINDOW
+    # seconds. Concurrent refreshes of one id are still coalesced by the lease in getAnimeV1.
+    if users.is_current_user_admin(): return True
+    if not ids: return False
+    window = str(int(time.time() // RESET_WINDOW))
+    counts = memcache.offset_multi(dict((i, 1) for i in ids), key_prefix = 'reset:' + window + ':', initial_value = 0)
+    allowed = all((counts.get(i) or 0) <= RESET_LIMIT for i in ids)
+    if not allowed: logging.info('Ignoring _reset for ' + ','.join(ids))
+    return allowed
+
+def errorBody(error):
+    return json.dumps({'ok': False, 'result': None, 'error': error}, sort_keys=True)
+
+def getAnimeV1(ids, reset=False, tiers=None):
+    # Memcache first, then the datastore, then upstream for whatever is still missing or stale.
+    # Returns AnimeEntry objects by id, the set of ids served from a stale datastore row
+    # and the error ('not_found' or 'upstream_error') for every id that could not be served.
+    # The TIERS entry each id was served from, or failed at, goes into tiers.
+    if tiers is None: tiers = {}
+    entries = {}
+    served = set()
+    errors = {}
+    if not reset:
+        entries.update(cacheGetMulti(ids, tiers))
+    missing = [i for i in ids if i not in entries]
+    if not missing: return entries, served, errors
+
+    # Ids known to have no row and to have failed upstream recently cost a single memcache lookup
+    if not reset:
+        with timed('memcache'):
+            errors.update(memcache.get_multi(missing, key_prefix = cachePrefix() + 'negative:'))
+        tiers.update((i, 'negative') for i in errors)
+        missing = [i for i in missing if i not in errors]
+        if not missing: return entries, served, errors
+
+    originals = {}
+    fresh = {}
+    staleEntries = {}
+    with timed('datastore'):
+        rows = AnimeV1.get_by_key_name(missing)
+    checked = checkedAnimeV1(rows)
+    for anime in rows:
+        if anime is None: continue
+        originals[anime.id] = anime
+        if isFresh(anime, checked.get(anime.id)):
+            fresh[anime.id] = AnimeEntry(animeContent(anime), anime.updated_datetime)
+        else:
+            staleEntries[anime.id] = AnimeEntry(animeContent(anime), anime.updated_datetime)
+    if fresh:
+        entries.update(cacheSetMulti(fresh))
+        tiers.update((i, 'datastore_fresh') for i in fresh)
+
+    stale = [i for i in missing if i not in fresh]
+    if STALE_WHILE_REVALIDATE and not reset:
+        # Serve stale rows right away and let a task refresh them from upstream
+        served.update(i for i in stale if i in staleEntries)
+        for i in served:
+            entries[i] = staleEntries[i]
+        tiers.update((i, 'datastore_stale') for i in served)
+        queueRefreshAnimeV1(acquireLeases(list(served), REFRESH_LEASE_TTL))
+        stale = [i for i in stale if i not in served]
+    if not stale: return entries, served, errors
+
+    # Only one request per id goes upstream, the rest wait for it to fill memcache
+    leased = acquireLeases(stale)
+    if leased:
+        try:
+            refreshed, failed = refreshAnimeV1(leased, originals, True, tiers)
+            entries.update(refreshed)
+            errors.update(failed)
+        finally:
+            memcache.delete_multi(leased, key_prefix = 'lease:')
+
+    waiting = [i for i in stale if i not in leased]
+    if waiting:
+        awaited, failed = awaitAnimeV1(waiting, tiers)
+        entries.update(awaited)
+        errors.update(failed)
+
+    # Upstream failed or the lease holder was too slow, serve the stale copy if there is one.
+    # Without one the client is asked to retry rather than going upstream as well, by then the
+    # lease holder has filled the cache or its negative result.
+    for i in stale:
+        if i in entries: continue
+        if i in staleEntries:
+            entries[i] = staleEntries[i]
+            errors.pop(i, None)
+            served.add(i)
+            tiers[i] = 'datastore_stale'
+        elif i in waiting and i not in errors:
+            errors[i] = 'upstream_error'
+    tiers.update((i, 'failure') for i in missing if i not in entries and i not in tiers)
+    return entries, served, errors
+
+def countTiers(tiers):
+    # Counts each id of a /v1/anime response once, under the tier that served it
+    counts = {}
+    for tier in tiers.values():
+        counts[tier] = counts.get(tier, 0) + 1
+    for tier, n in counts.items():
+        tierCounters.incr(tier, n)
+
+def isFresh(anime, checked=None):
+    # checked is when upstream last gave the row's data unchanged, see checkedAnimeV1
+    updated = anime.updated_datetime
+    if checked is not None and checked > updated: updated = checked
+    return datetime.now() - updated <= FRESH_AGE
+
+def checkedAnimeV1(rows):
+    # Refreshes that find nothing changed skip the write, so updated_datetime does not move and
+    # a checked: marker records when the row was confirmed instead. Returns those times by id
+    # for the rows that would otherwise be stale, which is the only time they are looked up.
+    ids = [anime.id for anime in rows if anime is not None and not isFresh(anime)]
+    if not ids: return {}
+    checked = memcache.get_multi(ids, key_prefix = 'checked:')
+    return dict((i, datetime.utcfromtimestamp(seconds)) for i, seconds in checked.items())
+
+def markCheckedAnimeV1(ids):
+    if not ids: return
+    now = calendar.timegm(datetime.now().timetuple())
+    memcache.set_multi(dict((i, now) for i in ids), int(FRESH_AGE.total_seconds()), key_prefix = 'checked:')
+
+def refreshAnimeV1(ids, originals, deferWrites=False, tiers=None):
+    # Returns the stored entries and the error for every id upstream could not provide.
+    # originals are the AnimeV1 rows we already loaded, by id.
+    contents, documents, notFound = fetchAnimeV1(ids, tiers)
+    entries = {}
+    writes = []
+    unchanged = []
+    with timed('store'):
+        for id, content in contents.items():
+            original = originals.get(id)
+            entries[id], anime = storeAnimeV1(id, content, documents.get(id), original)
+            if anime is None:
+                unchanged.append(id)
+                continue
+            writes.append(anime)
+            change = changeAnimeV1(anime, original)
+            if change is not None: writes.append(change)
+        putAnimeV1(writes, deferWrites)
+        markCheckedAnimeV1(unchanged)
+
+    errors = dict((i, 'not_found' if i in notFound else 'upstream_error') for i in ids if i not in entries)
+    # Only ids without a row are cached negatively, rows we have can still be served stale
+    for reason, ttl in (('not_found', NOT_FOUND_TTL), ('upstream_error', UPSTREAM_ERROR_TTL)):
+        negative = dict((i, reason) for i, error in errors.items() if error == reason and i not in originals)
+        if negative:
+            memcache.set_multi(negative, ttl, key_prefix = cachePrefix() + 'negative:')
+    return entries, errors
+
+def queueRefreshAnimeV1(ids):
+    if not ids: return
+    taskqueue.Queue().add([taskqueue.Task(url = '/tasks/refresh/animev1', params = {'id': i}) for i in ids])
+
+class RefreshAnimeV1Handler(webapp2.RequestHandler):
+    # Task queue worker, the lease was taken by whoever queued this task
+    def post(self):
+        id = self.request.get('id')
+        anime = AnimeV1.get_by_key_name(id)
+        originals = {id: anime} if anime is not None else {}
+        try:
+            refreshAnimeV1([id], originals)
+        finally:
+            memcache.delete('lease:' + id)
+
+def acquireLeases(ids, ttl=LEASE_TTL):
+    # memcache.add only succeeds for the first caller, returns the ids we now hold
+    if not ids: return []
+    notSet = memcache.add_multi(dict((i, 1) for i in ids), ttl, key_prefix = 'lease:')
+    return [i for i in ids if i not in notSet]
+
+def awaitAnimeV1(ids, tiers=None):
+    # Polls for the records, or the negative results, the lease holders write
+    entries = {}
+    errors = {}
+    deadline = time.time() + LEASE_WAIT
+    while True:
+        entries.update(cacheGetMulti([i for i in ids if i not in entries and i not in errors], tiers, True))
+        waiting = [i for i in ids if i not in entries and i not in errors]
+        if waiting:
+            negative = memcache.get_multi(waiting, key_prefix = cachePrefix() + 'negative:')
+            if tiers is not None: tiers.update((i, 'negative') for i in negative)
+            errors.update(negative)
+        if len(entries) + len(errors) == len(ids) or time.time() >= deadline:
+            return entries, errors
+        time.sleep(LEASE_POLL)
+
+class Upstream(object):
+    # Circuit breaker state is shared through memcache, latency samples for the adaptive deadline stay in-process
+    def __init__(self, name, url, html):
+        self.name = name
+        self.url = url
+        self.html = html
+        self._latencies = deque(maxlen = LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    def percentile(self):
+        # LATENCY_PERCENTILE of the recent latencies, None until there are enough samples
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < LATENCY_SAMPLES // 5: return None
+        return samples[int(len(samples) * LATENCY_PERCENTILE) - 1]
+
+    def deadline(self):
+        percentile = self.percentile()
+        if percentile is None: return MAX_DEADLINE
+        return min(MAX_DEADLINE, max(MIN_DEADLINE, percentile * DEADLINE_FACTOR))
+
+    def hedgeDelay(self):
+        # How long a fetch runs before the next upstream is tried as well
+        percentile = self.percentile()
+        if percentile is None: return MIN_DEADLINE
+        return min(MAX_DEADLINE, percentile)
+
+    def result(self, rpc, started, deadline):
+        # Returns the urlfetch result, or None when there was no response at all.
+        # 5xx responses are returned too so they can be logged, see failed().
+        try:
+            result = rpc.get_result()
+        except urlfetch.DeadlineExceededError:
+            self.observe(deadline)
+            return None
+        except urlfetch.Error:
+            return None
+        self.observe(time.time() - started)
+        return result
+
+    def failed(self, result):
+        return result is None or result.status_code >= 500
+
+    def observe(self, seconds):
+        recordTiming(self.name, seconds)
+        with self._lock:
+            self._latencies.append(seconds)
+
+UPSTREAMS = [Upstream('malapi', MALAPI, False), Upstream('malsite', MALSITE, True)]
+
+def closedUpstreams():
+    tripped = memcache.get_multi([upstream.name for upstream in UPSTREAMS], key_prefix = 'breaker:open:')
+    return [upstream for upstream in UPSTREAMS if upstream.name not in tripped]
+
+def recordUpstreamOutcomes(outcomes):
+    # Counts successes and failures per upstream in fixed windows, and trips the breaker
+    # for BREAKER_COOLDOWN seconds once failures pass the threshold and outnumber successes
+    if not outcomes: return
+    window = str(int(time.time() // BREAKER_WINDOW))
+    counts = memcache.offset_multi(dict(('breaker:' + key[0] + ':' + window + ':' + key[1], delta) for key, delta in outcomes.items()), initial_value = 0)
+    if not counts: return
+    for upstream in UPSTREAMS:
+        prefix = 'breaker:' + upstream.name + ':' + window + ':'
+        failures = counts.get(prefix + 'fail') or 0
+        successes = counts.get(prefix + 'ok') or 0
+        if failures >= BREAKER_THRESHOLD and failures > successes:
+            logging.warning('Opening circuit breaker for ' + upstream.name)
+            memcache.set('breaker:open:' + upstream.name, 1, BREAKER_COOLDOWN)
+
+def fetchAnimeV1(ids, tiers=None):
+    # Fetches every id from the first upstream whose breaker is closed, MALAPI when it is up, and hedges
+    # with the next one when that fetch fails or is still running after the upstream's hedgeDelay. The
+    # first usable result wins and the id's other fetch is no longer waited on. Up to UPSTREAM_CONCURRENCY
+    # fetches are in flight at once, a new id starting as soon as another is done, and none run past
+    # FETCH_BUDGET seconds. Ids only take up to their share of the window, so hedges never wait for room.
+    # Returns the contents and full upstream documents by id, and the set of ids an upstream answered 404 for.
+    # The upstream each id came from goes into tiers.
+    contents = {}
+    documents = {}
+    notFound = set()
+    upstreams = closedUpstreams()
+    if not upstreams:
+        logging.warning('All upstreams are unavailable, not fetching ' + ','.join(ids))
+        return contents, documents, notFound
+
+    outcomes = {}
+    budget = time.time() + FETCH_BUDGET
+    perWindow = max(1, UPSTREAM_CONCURRENCY // len(upstreams))
+    queue = deque(ids)
+    pending = {}
+    # Index of the next upstream to try for each started id, and when to start it if nothing came back
+    nextUpstream = {}
+    hedges = {}
+
+    def start(id, index):
+        upstream = upstreams[index]
+        deadline = min(upstream.deadline(), budget - time.time())
+        rpc = urlfetch.create_rpc(deadline = deadline)
+        urlfetch.make_fetch_call(rpc, upstream.url + id, allow_truncated = upstream.html)
+        pending[rpc] = (id, upstream, time.time(), deadline)
+        nextUpstream[id] = index + 1
+        hedges.pop(id, None)
+        if index + 1 < len(upstreams):
+            hedges[id] = time.time() + upstream.hedgeDelay()
+
+    while queue or pending or hedges:
+        # Due hedges go first so started ids finish before new ones begin
+        now = time.time()
+        due = sorted((at, id) for id, at in hedges.items() if at <= now)
+        for at, id in due:
+            if len(pending) >= UPSTREAM_CONCURRENCY or now >= budget: break
+            start(id, nextUpstream[id])
+        active = set(p[0] for p in pending.values()).union(hedges)
+        while queue and len(active) < perWindow and now < budget:
+            active.add(queue[0])
+            start(queue.popleft(), 0)
+        if now >= budget and (queue or hedges):
+            logging.warning('Out of time, not fetching ' + ','.join(uniqueList(list(queue) + hedges.keys())))
+            queue.clear()
+            hedges.clear()
+        if not pending:
+            if not hedges: break
+            time.sleep(max(0, min(hedges.values()) - time.time()))
+            continue
+
+        if hedges and len(pending) < UPSTREAM_CONCURRENCY:
+            rpc = waitAny(pending.keys(), min(min(hedges.values()), budget))
+            if rpc is None: continue
+        else:
+            rpc = apiproxy_stub_map.UserRPC.wait_any(pending.keys())
+        id, upstream, started, deadline = pending.pop(rpc)
+        result = upstream.result(rpc, started, deadline)
+        logUpstream(id, upstream, result, time.time() - started)
+        failed = upstream.failed(result)
+        key = (upstream.name, 'fail' if failed else 'ok')
+        outcomes[key] = outcomes.get(key, 0) + 1
+        content = None
+        if not failed and result.status_code == 404:
+            notFound.add(id)
+        elif not failed:
+            with timed('format'):
+                content, document = parseResult(result, upstream.html)
+        if content is not None:
+            contents[id] = content
+            documents[id] = document
+            if tiers is not None: tiers[id] = upstream.name
+            hedges.pop(id, None)
+            # The other upstream's fetch of this id is left to run out on its own
+            for other in [r for r, p in pending.items() if p[0] == id]:
+                del pending[other]
+        elif id in hedges:
+            # Nothing usable, hedge right away
+            hedges[id] = 0
+    recordUpstreamOutcomes(outcomes)
+    return contents, documents, notFound.difference(contents)
+
+def waitAny(rpcs, until):
+    # Like UserRPC.wait_any, which has no timeout, but returns None once until passes.
+    # Checks the same RPC states wait_any does, every HEDGE_POLL seconds.
+    while True:
+        for rpc in rpcs:
+            if rpc.state == apiproxy_rpc.RPC.FINISHING: return rpc
+        if time.time() >= until: return None
+        time.sleep(HEDGE_POLL)
+
+def logUpstream(id, upstream, result, seconds):
+    # One structured line for a sample of upstream fetches, and for every fetch of an id being debugged,
+    # which also gets the start of the response body so scraper breakage can be looked at
+    enabled, ids = upstreamDebug()
+    debug = enabled or id in ids
+    if not debug and random.random() >= UPSTREAM_LOG_SAMPLE: return
+    fields = {
+        'id': id,
+        'upstream': upstream.name,
+        'status': result.status_code if result is not None else None,
+        'bytes': len(result.content) if result is not None else 0,
+        'ms': int(seconds * 1000)
+    }
+    if debug and result is not None:
+        fields['body'] = result.content[:DEBUG_BODY_BYTES].decode('utf-8', 'replace')
+    logging.info('Upstream fetch ' + json.dumps(fields, sort_keys=True))
+
+def upstreamDebug():
+    # Whether upstream debugging is on for every id, and the ids it is on for. Kept in-process
+    # for DEBUG_CONFIG_TTL seconds, so a change reaches every instance within that time.
+    config = debugCache.getMulti(['upstream']).get('upstream')
+    if config is None:
+        stored = UpstreamDebug.get_by_key_name('upstream')
+        config = (stored.enabled, frozenset(stored.ids)) if stored is not None else (False, frozenset())
+        debugCache.setMulti({'upstream': config})
+    return config
+
+class UpstreamDebugHandler(webapp2.RequestHandler):
+    # Turns upstream debug logging on for every fetch (enabled=1) or for a comma-separated list of ids
+    def get(self):
+        enabled, ids = upstreamDebug()
+        self.response.out.write(adminForm('Save', ('enabled', 'ids')) + '<p>Currently ' + ('on for every id' if enabled else 'on for ' + (','.join(sorted(ids)) or 'no ids')) + '</p>')
+
+    def post(self):
+        checkOrigin(self)
+        enabled = self.request.get('enabled') in ('1', 'true', 'on')
+        ids = [i for i in uniqueList(self.request.get('ids').split(',')) if re.match(r'^\d+$', i)]
+        UpstreamDebug(key_name = 'upstream', enabled = enabled, ids = ids).put()
+        debugCache.clear()
+        logging.info('Upstream debugging ' + ('enabled' if enabled else 'disabled') + ', ids ' + ','.join(ids))
+        self.response.out.write('Upstream debugging is ' + ('on for every id' if enabled else 'on for ' + (','.join(ids) or 'no ids')))
+
+def parseResult(result, html):
+    # Returns the formatted content and the full upstream document it came from.
+    # Scraped pages have no document, so the one already stored is kept.
+    if result.status_code != 200: return None, None
+    try:
+        if html:
+            return formatResponse(result.content, True), None
+        document = json.loads(result.content)
+        return formatResponse(document), document
+    except (ValueError, KeyError, TypeError):
+        # Malformed payload from one upstream should not lose the other one's answer
+        logging.exception('Unable to parse upstream response')
+        return None, None
+
+def animeContent(anime):
+    return {
+        'id': anime.id,
+        'title': anime.title,
+        'image': anime.image,
+        'score': anime.score,
+        'episodes': anime.episodes,
+        'genres': anime.genres
+    }
+
+class Field(object):
+    # Declarative spec for one output field: where to find it, how to convert it, and what to do when it is missing
+    def __init__(self, name, source, convert=None, default=None, required=False):
+        self.name = name
+        self.source = source
+        self.convert = convert
+        self.default = default
+        self.required = required
+
+class Extractor(object):
+    # Applies a list of Field specs to upstream content, keeping running per-field timings.
+    # Subclasses compile the specs once in __init__ and implement find().
+    def __init__(self, fields):
+        self.fields = fields
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def extract(self, content):
+        # Returns the converted fields, or None when a required field is missing
+        started = time.time()
+        raw = self.find(content)
+        spent = [('find', time.time() - started)]
+        result = {}
+        for field in self.fields:
+            started = time.time()
+            if field.name in raw:
+                value = raw[field.name]
+                if field.convert is not None and value is not None:
+                    value = field.convert(value)
+            elif field.required:
+                self.record(spent)
+                return None
+            else:
+                value = field.default
+            result[field.name] = value
+            spent.append((field.name, time.time() - started))
+        self.record(spent)
+        return result
+
+    def record(self, spent):
+        with self._lock:
+            for name, seconds in spent:
+                timing = self._timings.setdefault(name, [0, 0.0])
+                timing[0] += 1
+                timing[1] += seconds
+
+    def timings(self):
+        # Average milliseconds spent per field, 'find' being the parse or scan of the whole content
+        with self._lock:
+            return dict((name, {'count': count, 'avg_ms': total * 1000 / count}) for name, (count, total) in self._timings.items())
+
+class JSONExtractor(Extractor):
+    # Field sources are key paths into the document, dotted for nested keys.
+    # Content can be the JSON text or the already decoded document.
+    def __init__(self, fields):
+        Extractor.__init__(self, fields)
+        self._paths = [(field.name, field.source.split('.')) for field in fields]
+
+    def find(self, content):
+        data = json.loads(content) if isinstance(content, basestring) else content
+        raw = {}
+        for name, path in self._paths:
+            value = data
+            for key in path:
+                if not isinstance(value, dict) or key not in value: break
+                value = value[key]
+            else:
+                raw[name] = value
+        return raw
+
+class PatternExtractor(Extractor):
+    # Field sources are regexes with exactly one group. They are joined into one alternation,
+    # so the content is scanned once, stopping as soon as every field has been seen.
+    def __init__(self, fields, flags=0):
+        Extractor.__init__(self, fields)
+        self._groups = {}
+        alternatives = []
+        for field in fields:
+            if re.compile(field.source, flags).groups != 1:
+                raise ValueError('Field ' + field.name + ' needs exactly one group')
+            alternatives.append('(?:' + field.source + ')')
+            self._groups[len(alternatives)] = field.name
+        self._pattern = re.compile('|'.join(alternatives), flags)
+
+    def find(self, content):
+        raw = {}
+        for match in self._pattern.finditer(content):
+            name = self._groups[match.lastindex]
+            if name not in raw:
+                raw[name] = match.group(match.lastindex)
+                if len(raw) == len(self._groups): break
+        return raw
+
+def parseGenreLinks(html):
+    # Only the genre links are built into a tree
+    return [str(a.string) for a in BeautifulSoup(html, parse_only = SoupStrainer('a')).findAll('a')]
+
+MALAPI_EXTRACTOR = JSONExtractor([
+    Field('title', 'title', required = True),
+    Field('image', 'image_url', required = True),
+    Field('score', 'members_score', required = True),
+    Field('episodes', 'episodes', required = True),
+    Field('genres', 'genres', required = True)
+])
+
+# The ugly way to parse ugly HTML
+MALSITE_EXTRACTOR = PatternExtractor([
+    Field('title', r'<h1>\s*<div[^<>]*>[^<>]*</div>\s*([^<>]+)\s*<', lambda value: value.decode('utf-8'), required = True),
+    Field('image', r'">\s*<img\s+src="([^"<>\s]+)', required = True),
+    Field('score', r'Score:\s*</span>\s*([\d.]+)\s*<', float, 0),
+    Field('episodes', r'Episodes:\s*</span>\s*(\d+)\s*<', int),
+    Field('genres', r'Genres:\s*</span>\s*(.+?)\s*</div', parseGenreLinks, [])
+], re.I | re.U)
+
 def formatResponse(content, html=False):
     if html:
-        # The ugly way to parse ugly HTML
-
-        match = re.search(r'<h1>\s*<div[^<>]*>[^<>]*</div>\s*([^<>]+)\s*<', content, re.I | re.U)
-        title = match.group(1).decode('utf-8') if match else None
-        if title is None: return None
-
-        match = re.search(r'">\s*<img\s+src="([^"<>\s]+)', content, re.I)
-        image = match.group(1) if match else None
-        print image
-        if image is None: return None
-
-        match = re.search(r'Score:\s*</span>\s*([\d.]+)\s*<', content, re.I)
-        score = float(match.group(1)) if match else 0
-
-        match = re.search(r'Episodes:\s*</span>\s*(\d+)\s*<', content, re.I)
-        episodes = int(match.group(1)) if match else None
-
-        match = re.search(r'Genres:\s*</span>\s*(.+)\s*</div', content, re.I)
-        genresHTML = match.group(1) if match else None
-        soup = BeautifulSoup(genresHTML)
-        genresA = soup.findAll('a')
-        genres = []
-        for a in genresA:
-            genres.append(str(a.string))
-
-        return {
-            'title': title,
-            'image': image,
-            'score': score,
-            'episodes': episodes,
-            'genres': genres
-        }
+        return MALSITE_EXTRACTOR.extract(content)
     else:
-        data = json.loads(content)
-        return {
-            'title': data['title'],
-            'image': data['image_url'],
-            'score': data['members_score'],
-            'episodes': data['episodes'],
-            'genres': data['genres']
-        }
-
-def storeAnimeV1(id, data):
-    memcache.set(id, data, 43200)
-    q = db.GqlQuery('select * from AnimeV1 where id = :1', id)
-    anime = q.get()
+        return MALAPI_EXTRACTOR.extract(content)
+
+def storeAnimeV1(id, data, document=None, original=None):
+    # Caches the record and its document and returns its entry along with the AnimeV1 row to put,
+    # or None when nothing changed, in which case the caller marks the row checked instead.
+    # Without a new document the original row's document is kept.
+
+    # Upstream content has no id, add it so fresh and cached responses look the same
+    data = dict(data, id = id)
+    entry = cacheSetMulti({id: AnimeEntry(data, datetime.now())})[id]
+    if document is not None:
+        document = compressDocument(document)
+    elif original is not None:
+        document = original.document
+    if document is not None:
+        memcache.set(cachePrefix() + 'document:' + id, document, 43200)
+    else:
+        memcache.delete(cachePrefix() + 'document:' + id)
 
     # If genres is string, make it a list, just in case
     genres = data['genres']
     if genres is not None and isinstance(genres, str):
         genres = [genres]
 
-    if not anime:
-        anime = AnimeV1(
-            id = id,
-            title = data['title'],
-            image = data['image'],
-            score = data['score'],
-            episodes = data['episodes'],
-            genres = genres
-        )
-    else:
-        anime.title = data['title']
-        anime.image = data['image']
-        anime.score = data['score']
-        anime.episodes = data['episodes']
-        anime.genres = genres
-    anime.put()
+    anime = AnimeV1(
+        key_name = id,
+        id = id,
+        title = data['title'],
+        image = data['image'],
+        score = data['score'],
+        episodes = data['episodes'],
+        genres = genres,
+        document = document
+    )
+    if original is not None and all(getattr(anime, p) == getattr(original, p) for p in COMPARED_PROPERTIES):
+        return entry, None
+    return entry, anime
+
+def changeAnimeV1(anime, original):
+    # Returns the AnimeV1Change to put along with anime, or None when there is no original or nothing we track moved
+    if original is None: return None
+    changes = dict((p, [getattr(original, p), getattr(anime, p)]) for p in CHANGE_PROPERTIES if getattr(anime, p) != getattr(original, p))
+    if not changes: return None
+    return AnimeV1Change(id = anime.id, changes = json.dumps(changes, sort_keys = True, separators = (',', ':')))
+
+def putAnimeV1(entities, defer=False):
+    # Deferred writes are handed to a task so the request never waits on the datastore,
+    # split so no task payload goes over STORE_TASK_BYTES
+    if not entities: return
+    if not defer:
+        db.put(entities)
+        return
+    tasks = []
+    batch = []
+    size = 0
+    for anime in entities:
+        encoded = db.model_to_protobuf(anime).Encode()
+        if batch and size + len(encoded) > STORE_TASK_BYTES:
+            tasks.append(batch)
+            batch = []
+            size = 0
+        batch.append(encoded)
+        size += len(encoded)
+    tasks.append(batch)
+    taskqueue.Queue().add([taskqueue.Task(url = '/tasks/store/animev1', payload = cPickle.dumps(chunk, cPickle.HIGHEST_PROTOCOL)) for chunk in tasks])
+
+class StoreAnimeV1Handler(webapp2.RequestHandler):
+    # Task queue worker flushing deferred AnimeV1 writes in one batch put
+    def post(self):
+        db.put([db.model_from_protobuf(encoded) for encoded in cPickle.loads(self.request.body)])
+
+def compressDocument(document):
+    # Sorted keys keep the bytes stable, so unchanged documents compare equal
+    return zlib.compress(json.dumps(document, sort_keys = True, separators = (',', ':')))
+
+def getDocuments(ids):
+    # Full upstream documents, compressed in memcache and in AnimeV1.document
+    blobs = memcache.get_multi(ids, key_prefix = cachePrefix() + 'document:')
+    missing = [i for i in ids if i not in blobs]
+    if missing:
+        loaded = {}
+        for anime in AnimeV1.get_by_key_name(missing):
+            if anime is not None and anime.document is not None:
+                loaded[anime.id] = anime.document
+        if loaded:
+            memcache.set_multi(loaded, 43200, key_prefix = cachePrefix() + 'document:')
+            blobs.update(loaded)
+    return dict((i, json.loads(zlib.decompress(blob))) for i, blob in blobs.items())
+
+def projectAnimeV1(entries, fields):
+    # Basic fields come straight from the cached record, anything else from the stored upstream document
+    documents = {}
+    if not BASIC_FIELDS.issuperset(fields):
+        documents = getDocuments(entries.keys())
+    projected = {}
+    for i, entry in entries.items():
+        source = dict(documents.get(i) or {})
+        source.update(entry.content)
+        source['id'] = i
+        projected[i] = AnimeEntry(dict((f, source[f]) for f in fields if f in source), entry.updated)
+    return projected
+
+class MigrateAnimeV1Handler(webapp2.RequestHandler):
+    # One-off job re-keying AnimeV1 rows from auto ids to MAL id key names
+    def get(self):
+        self.response.out.write(adminForm('Start migration'))
+
+    def post(self):
+        checkOrigin(self)
+        taskqueue.add(url = '/tasks/migrate/animev1')
+        self.response.out.write('Migration started')
+
+class MigrateAnimeV1TaskHandler(webapp2.RequestHandler):
+    # Task queue worker re-keying one MIGRATE_BATCH and queueing the next
+    def post(self):
+        q = AnimeV1.all()
+        cursor = self.request.get('cursor')
+        if cursor: q.with_cursor(cursor)
+        batch = q.fetch(MIGRATE_BATCH)
+
+        old = [anime for anime in batch if anime.key().name() is None]
+        if old:
+            keyed = AnimeV1.get_by_key_name([anime.id for anime in old])
+            # Copied through the low-level API, saving a model would stamp updated_datetime with
+            # the migration time and make every old row look fresh
+            sources = datastore.Get([anime.key() for anime in old])
+            rekeyed = {}
+            for anime, existing, source in zip(old, keyed, sources):
+                # Rows already written under the new key are newer, keep those
+                if existing is not None or source is None: continue
+                entity = datastore.Entity('AnimeV1', name = anime.id)
+                entity.update(source)
+                rekeyed[anime.id] = entity
+            datastore.Put(rekeyed.values())
+            db.delete(old)
+        logging.info('Migrated ' + str(len(old)) + ' of ' + str(len(batch)) + ' AnimeV1 rows')
+
+        if len(batch) == MIGRATE_BATCH:
+            taskqueue.add(url = '/tasks/migrate/animev1', params = {'cursor': q.cursor()})
+
+class WarmupAnimeV1Handler(webapp2.RequestHandler):
+    # Loads the given ids, or the N most recently updated rows, into memcache after a deploy or flush
+    def get(self):
+        self.response.out.write(adminForm('Warm up', ('ids', 'top')))
+
+    def post(self):
+        checkOrigin(self)
+        ids = uniqueList(self.request.get('ids').split(','))
+        top = self.request.get('top')
+        if re.match(r'^\d+$', top):
+            ids = uniqueList(ids + recentAnimeV1Ids(int(top)))
+        ids = [i for i in ids if re.match(r'^\d+$', i)]
+        queueWarmupAnimeV1(ids)
+        self.response.out.write('Warming up ' + str(len(ids)) + ' ids')
+
+class WarmupAnimeV1TaskHandler(webapp2.RequestHandler):
+    # Task queue worker warming up one WARMUP_BATCH
+    def post(self):
+        warmAnimeV1(self.request.get('ids').split(','))
+
+def adminForm(action, fields=()):
+    # Admin actions change state, so GET only shows a form that POSTs them back to the same URL
+    inputs = ''.join('<p><label>' + f + ' <input name="' + f + '"></label></p>' for f in fields)
+    return '<!DOCTYPE html><title>Kanade</title><form method="post">' + inputs + '<p><button>' + action + '</button></p></form>'
+
+def checkOrigin(handler):
+    # Browsers send Origin with cross-site POSTs, which login: admin alone would let through on the admin's cookie
+    origin = handler.request.headers.get('Origin')
+    if origin and urlparse(origin).netloc != handler.request.host:
+        logging.warning('Refusing ' + handler.request.path + ' from ' + origin)
+        handler.abort(403)
+
+def recentAnimeV1Ids(count):
+    keys = AnimeV1.all(keys_only = True).order('-updated_datetime').fetch(min(count, WARMUP_MAX))
+    return [key.name() for key in keys if key.name()]
+
+def queueWarmupAnimeV1(ids):
+    # The warmup queue runs few tasks at a time, so a big list warms up gradually
+    for i in range(0, len(ids), WARMUP_BATCH):
+        taskqueue.add(url = '/tasks/warmup/animev1', queue_name = 'warmup', params = {'ids': ','.join(ids[i:i + WARMUP_BATCH])})
+
+def warmAnimeV1(ids):
+    fresh = {}
+    stale = []
+    originals = {}
+    rows = AnimeV1.get_by_key_name(ids)
+    checked = checkedAnimeV1(rows)
+    for id, anime in zip(ids, rows):
+        if anime is not None and isFresh(anime, checked.get(id)):
+            fresh[id] = AnimeEntry(animeContent(anime), anime.updated_datetime)
+            continue
+        stale.append(id)
+        if anime is not None: originals[id] = anime
+    cacheSetMulti(fresh)
+
+    # Skip ids some request is already refreshing
+    leased = acquireLeases(stale)
+    if leased:
+        try:
+            refreshAnimeV1(leased, originals)
+        finally:
+            memcache.delete_multi(leased, key_prefix = 'lease:')
+    logging.info('Warmed up ' + str(len(fresh)) + ' cached and ' + str(len(leased)) + ' refreshed of ' + str(len(ids)) + ' ids')
+
+class InvalidateAnimeV1Handler(webapp2.RequestHandler):
+    # Drops every cached record logically by moving to a new cache generation, then warms up
+    # the `warm` most recently updated ids (INVALIDATE_WARMUP by default) through the warmup queue
+    def get(self):
+        self.response.out.write(adminForm('Invalidate', ('warm',)))
+
+    def post(self):
+        checkOrigin(self)
+        generation = bumpCacheGeneration()
+        warm = self.request.get('warm')
+        ids = recentAnimeV1Ids(int(warm) if re.match(r'^\d+$', warm) else INVALIDATE_WARMUP)
+        queueWarmupAnimeV1(ids)
+        logging.info('Cache generation is now ' + str(generation))
+        self.response.out.write('Cache generation is now ' + str(generation) + ', warming up ' + str(len(ids)) + ' ids')
+
+class CrawlAnimeV1Handler(webapp2.RequestHandler):
+    # Cron job refreshing the least recently updated rows, so reads rarely have to go upstream.
+    # Runs every minute and sends at most CRAWL_PER_MINUTE requests upstream per run, each id being
+    # fetched at most once from every upstream. Rows that changed are rewritten and move to the back
+    # of the queue, but unchanged rows are only marked checked and rows that keep failing do not move
+    # at all, so each run carries on after the last row it looked at, starting over from the oldest
+    # row once it runs out.
+    def get(self):
+        perRun = max(1, CRAWL_PER_MINUTE // len(UPSTREAMS))
+        position = memcache.get('crawl:position') or datetime(1970, 1, 1)
+        q = AnimeV1.all().order('updated_datetime')
+        q.filter('updated_datetime >', position).filter('updated_datetime <', datetime.now() - CRAWL_MIN_AGE)
+        rows = [anime for anime in q.fetch(perRun * 2) if anime.key().name()]
+
+        # Ids that failed recently are skipped until CRAWL_FAILURE_TTL passes, checked ones until they go stale
+        failed = memcache.get_multi([anime.id for anime in rows], key_prefix = 'crawlfail:')
+        checked = checkedAnimeV1(rows)
+        originals = {}
+        seen = 0
+        for anime in rows:
+            if len(originals) == perRun: break
+            seen += 1
+            position = anime.updated_datetime
+            if anime.id not in failed and not isFresh(anime, checked.get(anime.id)): originals[anime.id] = anime
+        if seen == len(rows) and len(rows) < perRun * 2:
+            memcache.delete('crawl:position')
+        else:
+            memcache.set('crawl:position', position)
+        if not originals: return
+
+        leased = acquireLeases(originals.keys())
+        try:
+            refreshed, failed = refreshAnimeV1(leased, originals)
+        finally:
+            memcache.delete_multi(leased, key_prefix = 'lease:')
+        memcache.set_multi(dict((i, 1) for i in leased if i not in refreshed), CRAWL_FAILURE_TTL, key_prefix = 'crawlfail:')
+        logging.info('Crawled ' + str(len(refreshed)) + ' of ' + str(len(leased)) + ' ids')
 
 app = webapp2.WSGIApplication([
         ('/', MainHandler),
-        ('/v1/anime', AnimeV1Handler)
+        ('/v1/anime', AnimeV1Handler),
+        ('/v1/stats', StatsV1Handler),
+        ('/v1/changes', ChangesV1Handler),
+        ('/v1/export', ExportV1Handler),
+        ('/admin/migrate/animev1', MigrateAnimeV1Handler),
+        ('/admin/warmup/animev1', WarmupAnimeV1Handler),
+        ('/admin/invalidate/animev1', InvalidateAnimeV1Handler),
+        ('/admin/crawl/animev1', CrawlAnimeV1Handler),
+        ('/admin/stats/tiers', TierStatsHandler),
+        ('/admin/debug/upstream', UpstreamDebugHandler),
+        ('/tasks/refresh/animev1', RefreshAnimeV1Handler),
+        ('/tasks/store/animev1', StoreAnimeV1Handler),
+        ('/tasks/migrate/animev1', MigrateAnimeV1TaskHandler),
+        ('/tasks/warmup/animev1', WarmupAnimeV1TaskHandler)
     ], debug=True)
\ No newline at end of file